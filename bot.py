@@ -1,19 +1,56 @@
-import gzip
+import asyncio
+import atexit
+import hmac
 import logging
 import os
-import subprocess
-from logging.handlers import TimedRotatingFileHandler
+import queue
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, wraps
+from logging.handlers import MemoryHandler, QueueHandler, QueueListener, TimedRotatingFileHandler
 from pathlib import Path
+from time import monotonic
 
 import colorama
+import httpx
 import platformdirs
-import pretty_errors as _
+import zstandard
 from colorama import Fore, Style
 from dotenv import load_dotenv
 from mcstatus import JavaServer
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, PicklePersistence
-from telegram.helpers import escape_markdown
+from telegram.ext import (
+    AIORateLimiter,
+    Application,
+    ApplicationBuilder,
+    CommandHandler,
+    ContextTypes,
+    PicklePersistence,
+)
+
+# uvloop doesn't support Windows, where the default event loop is used instead
+if sys.platform != "win32":
+    import uvloop
+
+load_dotenv()
+
+# pretty_errors only makes tracebacks easier to read, so don't pay for importing it outside of development
+if os.getenv("DEV"):
+    import pretty_errors  # noqa: F401
+
+# Where the bot keeps its logs and its data, created once at startup
+LOG_DIR = Path(platformdirs.user_log_dir("mc_telegram_bot", "PurpleMyst", ensure_exists=True))
+DATA_DIR = Path(platformdirs.user_data_dir("mc_telegram_bot", "PurpleMyst", ensure_exists=True))
+
+LOG_SEPARATOR = " - "
+
+
+@cache
+def color_logger_name(name):
+    # There's only a handful of loggers, so remember their colored names instead of rebuilding them for every record
+    return f"{Fore.BLUE}{name}{Style.RESET_ALL}"
 
 
 class ColorFormatter(logging.Formatter):
@@ -30,64 +67,160 @@ class ColorFormatter(logging.Formatter):
         logging.CRITICAL: Fore.MAGENTA + Style.BRIGHT,
     }
 
+    # The colored level names never change, so build them once
+    COLORED_LEVEL_NAMES = {
+        level: f"{color}{logging.getLevelName(level)}{Style.RESET_ALL}" for level, color in LEVEL_COLORS.items()
+    }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_second = None
+        self.last_timestamp = ""
+
+    def formatTime(self, record, datefmt=None):
+        # Without a datefmt the timestamp includes milliseconds, so it can't be reused
+        if datefmt is None:
+            return super().formatTime(record, datefmt)
+
+        # Records logged within the same second share their timestamp, so only call strftime once per second
+        second = int(record.created)
+        if second != self.last_second:
+            self.last_second = second
+            self.last_timestamp = super().formatTime(record, datefmt)
+        return self.last_timestamp
+
     def format(self, record):
+        # Build everything from locals: the record is shared with the file handler, which must not see the colors.
+
         # Add color to the log level
-        level_color = self.LEVEL_COLORS.get(record.levelno, "")
-        record.levelname = f"{level_color}{record.levelname}{Style.RESET_ALL}"
+        levelname = self.COLORED_LEVEL_NAMES.get(record.levelno, record.levelname)
 
         # Add color to the logger name
-        record.name = f"{Fore.BLUE}{record.name}{Style.RESET_ALL}"
+        name = color_logger_name(record.name)
 
         # Add color to the timestamp
         timestamp = self.formatTime(record, self.datefmt)
 
-        # Populate the message field
-        record.message = record.getMessage()
-
         # Format the log message ourselves, to avoid depending on asctime.
-        formatted_message = " - ".join(
+        # A single join over every piece builds the whole line in one allocation.
+        formatted_message = "".join(
             (
-                f"{Fore.MAGENTA}{timestamp}{Style.RESET_ALL}",
-                record.name,
-                record.levelname,
-                record.message,
+                Fore.MAGENTA,
+                timestamp,
+                Style.RESET_ALL,
+                LOG_SEPARATOR,
+                name,
+                LOG_SEPARATOR,
+                levelname,
+                LOG_SEPARATOR,
+                record.getMessage(),
             )
         )
         return formatted_message
 
 
+# zstd level used for rotated logs: low levels are already much smaller and faster than gzip ever was
+LOG_COMPRESSION_LEVEL = 3
+
+
 def compress_log_file(log_file_path):
     if not os.path.exists(log_file_path):
         return
-    with open(log_file_path, "rb") as f_in, gzip.open(f"{log_file_path}.gz", "wb") as f_out:
-        f_out.writelines(f_in)
+    # zstd compresses log text both better and faster than gzip, and threads=-1 uses every core.
+    # Feed it 1 MiB at a time, so each call hands the compressor a large contiguous block.
+    # Write under a name the rotating handler doesn't recognise as a backup, and only move it into place once it's
+    # complete: otherwise a rollover happening meanwhile would count this day twice and delete one backup too many.
+    directory, name = os.path.split(log_file_path)
+    partial_path = os.path.join(directory, f"compressing-{name}.zst")
+    compressor = zstandard.ZstdCompressor(level=LOG_COMPRESSION_LEVEL, threads=-1)
+    with open(log_file_path, "rb") as f_in, open(partial_path, "wb") as f_out:
+        compressor.copy_stream(f_in, f_out, read_size=1 << 20)
+    os.replace(partial_path, f"{log_file_path}.zst")
     os.remove(log_file_path)  # Remove the uncompressed log file
 
 
+# Compress rotated logs on their own thread, so the queue listener can keep writing records in the meantime.
+# A single worker keeps the rotations in order.
+LOG_COMPRESSION_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-compression")
+
+
+def rotate_log_file(source, dest):
+    # Move the log out of the way right away, so the handler can reopen a fresh one while the old one is compressed
+    # (compress_log_file adds the .zst suffix that the namer put on dest)
+    uncompressed = dest.removesuffix(".zst")
+    os.rename(source, uncompressed)
+    LOG_COMPRESSION_POOL.submit(compress_log_file, uncompressed).add_done_callback(log_compression_failure)
+
+
+def log_compression_failure(future):
+    # Nothing waits on the compression, so this is the only place its errors can surface
+    if (exception := future.exception()) is not None:
+        logger.error("Error compressing a rotated log file", exc_info=exception)
+
+
+# How often buffered log records are written to the log file even if the buffer isn't full, in seconds
+LOG_FLUSH_INTERVAL = 30
+
+
+class LazyTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    A timed rotating file handler that only touches the filesystem when a rollover is actually due.
+    """
+
+    def shouldRollover(self, record):
+        # The record's creation time is just as good as asking the clock again
+        if record.created < self.rolloverAt:
+            return False
+
+        # Never rollover anything other than regular files, like the standard library does
+        if os.path.exists(self.baseFilename) and not os.path.isfile(self.baseFilename):
+            self.rolloverAt = self.computeRollover(int(record.created))
+            return False
+
+        return True
+
+
 def setup_global_logging():
-    log_file = (
-        Path(platformdirs.user_log_dir("mc_telegram_bot", "PurpleMyst", ensure_exists=True))
-        / "bot.log"
-    )
+    # Only set up logging once, even if this module is loaded twice (e.g. both as __main__ and as bot):
+    # tearing the handlers down again would leave the first queue listener and its file open
+    if any(isinstance(handler, QueueHandler) for handler in logging.getLogger().handlers):
+        return
+
+    log_file = LOG_DIR / "bot.log"
     level = logging.INFO
 
-    # Create a console handler with color formatting
+    plain_formatter = logging.Formatter(
+        fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
+    )
+
+    # Create a console handler, with color formatting only when it's writing to a terminal
+    use_colors = sys.stderr.isatty()
+
+    # Terminals outside of Windows understand ANSI codes already. On Windows, colorama.init() replaces sys.stderr
+    # with a converting wrapper, so it must run before the handler grabs the stream.
+    if use_colors and sys.platform == "win32":
+        colorama.init()
+
     console_handler = logging.StreamHandler()
-    console_handler.setFormatter(ColorFormatter(datefmt="%Y-%m-%d %H:%M:%S"))
+    if use_colors:
+        console_handler.setFormatter(ColorFormatter(datefmt="%Y-%m-%d %H:%M:%S"))
+    else:
+        console_handler.setFormatter(plain_formatter)
 
     # Create a timed rotating file handler with compression
-    file_handler = TimedRotatingFileHandler(
+    file_handler = LazyTimedRotatingFileHandler(
         log_file,
         when="midnight",
         backupCount=7,  # Rotate logs daily, keep 7 days
     )
-    file_handler.setFormatter(
-        logging.Formatter(
-            fmt="%(asctime)s - %(name)s - %(levelname)s - %(message)s", datefmt="%Y-%m-%d %H:%M:%S"
-        )
+    file_handler.setFormatter(plain_formatter)
+    file_handler.namer = lambda name: name + ".zst"
+    file_handler.rotator = rotate_log_file
+
+    # Buffer records for the file handler, writing them out in batches (or right away on errors)
+    buffered_file_handler = MemoryHandler(
+        capacity=512, flushLevel=logging.ERROR, target=file_handler, flushOnClose=True
     )
-    file_handler.namer = lambda name: name + ".gz"
-    file_handler.rotator = lambda source, _: compress_log_file(source)
 
     # Get the root logger
     root_logger = logging.getLogger()
@@ -96,54 +229,145 @@ def setup_global_logging():
     # Clear existing handlers (avoid duplicate logs if called multiple times)
     root_logger.handlers.clear()
 
-    # Add the handlers to the root logger
-    root_logger.addHandler(console_handler)
-    root_logger.addHandler(file_handler)
+    # Only enqueue records on the calling thread, and let a background thread do the actual writing,
+    # so that logging doesn't block the event loop on disk I/O.
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, console_handler, buffered_file_handler, respect_handler_level=True)
+    listener.start()
+
+    # The bot is quiet most of the time, so also flush the buffer every so often instead of only when it fills up
+    stop_flushing = threading.Event()
+
+    def flush_periodically():
+        while not stop_flushing.wait(LOG_FLUSH_INTERVAL):
+            buffered_file_handler.flush()
+
+    threading.Thread(target=flush_periodically, name="log-flush", daemon=True).start()
+
+    def stop_logging():
+        # Drain the queue first, so that the last records make it into the buffer being flushed.
+        listener.stop()
+        stop_flushing.set()
+        buffered_file_handler.flush()
+
+    atexit.register(stop_logging)
 
     # Silence the overly verbose loggers from third-party libraries
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
-colorama.init()
 setup_global_logging()
 logger = logging.getLogger(__name__)
 
+# Kept as bytes, since that's what it's compared against on every /start
+SECRET_KEY = os.getenv("SECRET_KEY", "").encode()
+
+# How long a fetched public IP is reused before asking ifconfig.me again, in seconds.
+PUBLIC_IP_TTL = 60
+
+# How many broadcast messages may be waiting on Telegram at once. This only bounds the open requests:
+# staying under Telegram's limit of about 30 messages per second is up to the AIORateLimiter set up in main().
+BROADCAST_MAX_IN_FLIGHT = 30
+
+
+async def get_public_ip(context: ContextTypes.DEFAULT_TYPE) -> str:
+    cached = context.bot_data.get("public_ip_cache")
+    if cached is not None:
+        public_ip, fetched_at = cached
+        if monotonic() - fetched_at < PUBLIC_IP_TTL:
+            return public_ip
+
+    async with httpx.AsyncClient(timeout=5.0) as client:
+        response = await client.get("https://ifconfig.me")
+        response.raise_for_status()
+        public_ip = response.text.strip()
+
+    context.bot_data["public_ip_cache"] = (public_ip, monotonic())
+    return public_ip
+
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+START_SERVER_SCRIPT = str(SCRIPT_DIR / "start_server.sh")
+STOP_SERVER_SCRIPT = str(SCRIPT_DIR / "stop_server.sh")
+
+
+async def run_script(context: ContextTypes.DEFAULT_TYPE, script: str) -> None:
+    proc = await asyncio.create_subprocess_exec(script)
+
+    # Don't make the handler wait for the script, but keep a reference to the process until it exits:
+    # a garbage-collected subprocess transport kills the child it was managing.
+    async def wait():
+        returncode = await proc.wait()
+        logger.info("%s exited with code %s", script, returncode)
+
+    context.application.create_task(wait())
+
+
+def require_unlock(action: str, reply: str = "🔒 Devi sbloccare il bot per poter usare questo comando."):
+    """
+    Only run the decorated handler for users that have unlocked the bot with /start.
+    """
+
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            assert update.message is not None
+            assert update.effective_user is not None
+
+            user = update.effective_user
+            if user.id not in context.bot_data["users"]:
+                username = user.username if user.username else f"User_{user.id}"
+                logger.warning("User %s (id: %s) tried to %s without unlocking the bot", username, user.id, action)
+                await update.message.reply_text(reply)
+                return
+
+            return await handler(update, context)
+
+        return wrapper
+
+    return decorator
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
     assert update.effective_user is not None
 
     user = update.effective_user
     user_id = user.id
     username = user.username if user.username else f"User_{user_id}"
+    users = context.bot_data["users"]
 
-    if user_id in context.bot_data.get("users", set()):
+    if user_id in users:
         await update.message.reply_text("👋 Ciao! Sei già sbloccato.")
         return
 
-    match context.args:
-        case [key]:
-            if key != os.getenv("SECRET_KEY"):
-                logger.warning(f"Invalid secret key {key} from user {username} (id: {user_id})")
-                await update.message.reply_text("🔒 Chiave segreta errata. Riprova.")
-                return
+    args = context.args
+    if args is not None and len(args) == 1:
+        key = args[0]
+        if not hmac.compare_digest(key.encode(), SECRET_KEY):
+            logger.warning("Invalid secret key %s from user %s (id: %s)", key, username, user_id)
+            await update.message.reply_text("🔒 Chiave segreta errata. Riprova.")
+            return
 
-            if update.effective_user is not None:
-                logger.info(f"User {username} (id: {user_id}) has unlocked the bot")
-                await update.message.reply_text("🔓 Benvenuto! Ora puoi usare il bot.")
-                context.bot_data.setdefault("users", set()).add(user_id)
+        if update.effective_user is not None:
+            logger.info("User %s (id: %s) has unlocked the bot", username, user_id)
+            await update.message.reply_text("🔓 Benvenuto! Ora puoi usare il bot.")
+            with context.bot_data["users_db"] as users_db:
+                users_db.execute("INSERT OR IGNORE INTO users (id) VALUES (?)", (user_id,))
+            users.add(user_id)
+            context.bot_data["users_tuple"] = tuple(users)
 
-        case _:
-            logger.info(f"User {username} (id: {user_id}) tried to access the bot without a secret key")
-            await update.message.reply_text(
-                "Ciao! Per usare questo bot, devi conoscere la chiave segreta. "
-                "Scrivila dopo il comando /start 🤫🔑"
-            )
+    else:
+        logger.info("User %s (id: %s) tried to access the bot without a secret key", username, user_id)
+        await update.message.reply_text(
+            "Ciao! Per usare questo bot, devi conoscere la chiave segreta. "
+            "Scrivila dopo il comando /start 🤫🔑"
+        )
 
 
+@require_unlock("start the server", "🔒 Devi sbloccare il bot prima di poter avviare il server.")
 async def start_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
     assert update.effective_user is not None
 
@@ -151,34 +375,27 @@ async def start_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.username if user.username else f"User_{user_id}"
 
-    if user_id not in context.bot_data.get("users", set()):
-        logger.warning(f"User {username} (id: {user_id}) tried to start the server without unlocking the bot")
-        await update.message.reply_text(
-            "🔒 Devi sbloccare il bot prima di poter avviare il server."
-        )
-        return
-
     try:
-        subprocess.Popen(["bash", Path(__file__).parent / "start_server.sh"])
-    except Exception as e:
-        logger.error(f"Error starting the server: {e}")
+        await run_script(context, START_SERVER_SCRIPT)
+    except Exception:
+        logger.exception("Error starting the server")
         await update.message.reply_text("❌ Errore nell'avvio del server.")
         return
     else:
-        logger.info(f"User {username} (id: {user_id}) has started the server")
+        logger.info("User %s (id: %s) has started the server", username, user_id)
         await update.message.reply_text("🚀 Server avviato con successo!")
         try:
-            public_ip = subprocess.check_output(["curl", "-s", "ifconfig.me"]).decode().strip()
-        except Exception as e:
-            logger.error(f"Error getting the public IP: {e}")
+            public_ip = await get_public_ip(context)
+        except Exception:
+            logger.exception("Error getting the public IP")
             await update.message.reply_text("❌ Errore nel recupero dell'indirizzo IP pubblico.")
             return
-        logger.info(f"User {username} (id: {user_id}) has requested the public IP, which is {public_ip}")
+        logger.info("User %s (id: %s) has requested the public IP, which is %s", username, user_id, public_ip)
         await update.message.reply_text(f"🌐 L'indirizzo IP del server è: {public_ip}")
 
 
+@require_unlock("stop the server", "🔒 Devi sbloccare il bot prima di poter arrestare il server.")
 async def stop_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
     assert update.effective_user is not None
 
@@ -186,26 +403,19 @@ async def stop_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.username if user.username else f"User_{user_id}"
 
-    if user_id not in context.bot_data.get("users", set()):
-        logger.warning(f"User {username} (id: {user_id}) tried to stop the server without unlocking the bot")
-        await update.message.reply_text(
-            "🔒 Devi sbloccare il bot prima di poter arrestare il server."
-        )
-        return
-
     try:
-        subprocess.Popen(["bash", Path(__file__).parent / "stop_server.sh"])
-    except Exception as e:
-        logger.error(f"Error stopping the server: {e}")
+        await run_script(context, STOP_SERVER_SCRIPT)
+    except Exception:
+        logger.exception("Error stopping the server")
         await update.message.reply_text("❌ Errore nell'arresto del server.")
         return
     else:
-        logger.info(f"User {username} (id: {user_id}) has stopped the server")
+        logger.info("User %s (id: %s) has stopped the server", username, user_id)
         await update.message.reply_text("🛑 Server arrestato con successo!")
 
 
+@require_unlock("access the public IP")
 async def server_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
     assert update.effective_user is not None
 
@@ -213,24 +423,19 @@ async def server_ip(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.username if user.username else f"User_{user_id}"
 
-    if user_id not in context.bot_data.get("users", set()):
-        logger.warning(f"User {username} (id: {user_id}) tried to access the public IP without unlocking the bot")
-        await update.message.reply_text("🔒 Devi sbloccare il bot per poter usare questo comando.")
-        return
-
     try:
-        public_ip = subprocess.check_output(["curl", "-s", "ifconfig.me"]).decode().strip()
-    except Exception as e:
-        logger.error(f"Error getting the public IP: {e}")
+        public_ip = await get_public_ip(context)
+    except Exception:
+        logger.exception("Error getting the public IP")
         await update.message.reply_text("❌ Errore nel recupero dell'indirizzo IP pubblico.")
         return
     else:
-        logger.info(f"User {username} (id: {user_id}) has requested the public IP, which is {public_ip}")
+        logger.info("User %s (id: %s) has requested the public IP, which is %s", username, user_id, public_ip)
         await update.message.reply_text(f"🌐 L'indirizzo IP del server è: {public_ip}")
 
 
+@require_unlock("access the server status")
 async def server_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
     assert update.effective_user is not None
 
@@ -238,32 +443,29 @@ async def server_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.username if user.username else f"User_{user_id}"
 
-    if user_id not in context.bot_data.get("users", set()):
-        logger.warning(
-            f"User {username} (id: {user_id}) tried to access the server status without unlocking the bot"
-        )
-        await update.message.reply_text("🔒 Devi sbloccare il bot per poter usare questo comando.")
-        return
-
     try:
         server = JavaServer("localhost", 25565)
-        status = server.status()
-    except Exception as e:
-        logger.error(f"Error getting the server status: {e}")
+        status = await server.async_status()
+    except Exception:
+        logger.exception("Error getting the server status")
         await update.message.reply_text("❌ Errore nel recupero dello stato del server.")
         return
 
-    logger.info(f"User {username} (id: {user_id}) has requested the server status, which is {status!r}")
+    logger.info("User %s (id: %s) has requested the server status, which is %r", username, user_id, status)
     await update.message.reply_text(status_message(status), parse_mode="Markdown")
 
 
+# Same escaping as telegram.helpers.escape_markdown for the legacy Markdown parse mode, but as a single C-level pass
+MARKDOWN_ESCAPES = str.maketrans({char: f"\\{char}" for char in "_*`["})
+
+
 def status_message(status) -> str:
     msg_lines = ["🟢 Il server è online!"]
 
     if status.players.sample:
         msg_lines.append("👥 Giocatori online: ")
         msg_lines.extend(
-            f"  - {escape_markdown(player.name)} ({escape_markdown(player.id)})"
+            f"  - {player.name.translate(MARKDOWN_ESCAPES)} ({player.id.translate(MARKDOWN_ESCAPES)})"
             for player in status.players.sample
         )
     elif status.players.online:
@@ -275,8 +477,9 @@ def status_message(status) -> str:
 
     return "\n".join(msg_lines)
 
+
+@require_unlock("use /broadcast", "🔒 Devi sbloccare il bot per usare questo comando.")
 async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
     assert update.effective_user is not None
 
@@ -284,12 +487,6 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     username = user.username if user.username else f"User_{user_id}"
 
-    # Verifica che l'utente abbia sbloccato il bot
-    if user_id not in context.bot_data.get("users", set()):
-        logger.warning(f"User {username} (id: {user_id}) tried to use /broadcast without unlocking the bot")
-        await update.message.reply_text("🔒 Devi sbloccare il bot per usare questo comando.")
-        return
-
     # Rimuovi il comando e ottieni il messaggio completo
     if update.message.text is None or not update.message.text.strip():
         await update.message.reply_text("❌ Devi fornire un messaggio da inviare. Usa: /broadcast <messaggio>")
@@ -302,16 +499,21 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Il messaggio non può essere vuoto. Usa: /broadcast <messaggio>")
         return
 
-    logger.info(f"User {username} (id: {user_id}) is broadcasting: {message}")
+    logger.info("User %s (id: %s) is broadcasting: %s", username, user_id, message)
 
     # Invia il messaggio a tutti gli utenti
-    failed = []
-    for user in context.bot_data.get("users", set()):
-        try:
-            await context.bot.send_message(chat_id=user, text=message)
-        except Exception as e:
-            logger.error(f"Error sending broadcast to {user}: {e}")
-            failed.append(user)
+    semaphore = asyncio.Semaphore(BROADCAST_MAX_IN_FLIGHT)
+
+    async def send(chat_id):
+        async with semaphore:
+            try:
+                await context.bot.send_message(chat_id=chat_id, text=message)
+            except Exception as e:
+                logger.error("Error sending broadcast to %s: %s", chat_id, e)
+                return chat_id
+
+    results = await asyncio.gather(*(send(recipient) for recipient in context.bot_data["users_tuple"]))
+    failed = [recipient for recipient in results if recipient is not None]
 
     # Notifica l'utente sul risultato del broadcast
     if failed:
@@ -320,56 +522,85 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("✅ Messaggio inviato a tutti gli utenti!")
 
 
+COMMAND_DESCRIPTIONS = [
+    ("start", "Sblocca il bot"),
+    ("start_server", "Avvia il server"),
+    ("stop_server", "Arresta il server"),
+    ("server_ip", "Mostra l'indirizzo IP del server"),
+    ("server_status", "Mostra lo stato del server"),
+    ("broadcast", "Invia un messaggio a tutti gli utenti del bot"),
+]
+
+HELP_TEXT = (
+    "ℹ️ Questo bot ti permette di gestire un server Minecraft. "
+    "Ecco i comandi disponibili:\n"
+    + "\n".join(f"  - /{command}: {description}" for command, description in COMMAND_DESCRIPTIONS)
+)
+
+
+@require_unlock("access the help command")
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    assert context.bot_data is not None
     assert update.message is not None
-    assert update.effective_user is not None
 
-    user = update.effective_user
-    user_id = user.id
-    username = user.username if user.username else f"User_{user_id}"
+    await update.message.reply_text(HELP_TEXT)
 
-    if user_id not in context.bot_data.get("users", set()):
-        logger.warning(f"User {username} (id: {user_id}) tried to access the help command without unlocking the bot")
-        await update.message.reply_text("🔒 Devi sbloccare il bot per poter usare questo comando.")
-        return
 
-    commands = [
-        ("start", "Sblocca il bot"),
-        ("start_server", "Avvia il server"),
-        ("stop_server", "Arresta il server"),
-        ("server_ip", "Mostra l'indirizzo IP del server"),
-        ("server_status", "Mostra lo stato del server"),
-        ("broadcast", "Invia un messaggio a tutti gli utenti del bot"),
-    ]
-
-    await update.message.reply_text(
-        "ℹ️ Questo bot ti permette di gestire un server Minecraft. "
-        "Ecco i comandi disponibili:\n"
-        + "\n".join(f"  - /{command}: {description}" for command, description in commands)
-    )
+async def open_users_db() -> sqlite3.Connection:
+    users_db = sqlite3.connect(DATA_DIR / "users.db")
+    with users_db:
+        users_db.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY)")
 
-    await context.bot.set_my_commands(commands)
+    # Import the users unlocked back when the whole bot_data was pickled, then set the old file aside
+    legacy_data = DATA_DIR / "data.pkl"
+    if legacy_data.exists():
+        legacy_users = (await PicklePersistence(legacy_data).get_bot_data()).get("users", set())
+        with users_db:
+            users_db.executemany(
+                "INSERT OR IGNORE INTO users (id) VALUES (?)", ((user_id,) for user_id in legacy_users)
+            )
+        legacy_data.rename(legacy_data.with_suffix(".pkl.bak"))
+        logger.info("Imported %s users from %s", len(legacy_users), legacy_data)
 
+    return users_db
+
+
+async def post_init(application: Application):
+    # Only the unlocked users need to survive a restart, and they're stored one row at a time as they unlock the bot.
+    # The set is used for membership tests, while a tuple snapshot of it is what /broadcast iterates over.
+    users_db = await open_users_db()
+    users = {user_id for (user_id,) in users_db.execute("SELECT id FROM users")}
+    application.bot_data["users_db"] = users_db
+    application.bot_data["users"] = users
+    application.bot_data["users_tuple"] = tuple(users)
+    await application.bot.set_my_commands(COMMAND_DESCRIPTIONS)
 
-def main():
-    load_dotenv()
 
+async def post_shutdown(application: Application):
+    # This also runs when startup failed, possibly before post_init got to open the database
+    users_db = application.bot_data.get("users_db")
+    if users_db is not None:
+        users_db.close()
+
+
+def main():
     token = os.getenv("TELEGRAM_BOT_TOKEN")
     if token is None:
         raise ValueError("TELEGRAM_BOT_TOKEN is not set in .env file")
 
+    if not SECRET_KEY:
+        raise ValueError("SECRET_KEY is not set in .env file")
+
+    # run_polling() picks up the current event loop rather than creating one, so install a uvloop loop up front
+    if sys.platform != "win32":
+        asyncio.set_event_loop(uvloop.new_event_loop())
+
     application = (
         ApplicationBuilder()
         .token(token)
-        .persistence(
-            PicklePersistence(
-                Path(
-                    platformdirs.user_data_dir("mc_telegram_bot", "PurpleMyst", ensure_exists=True)
-                )
-                / "data.pkl"
-            )
-        )
+        # Keep every request, broadcasts included, within Telegram's flood limits, retrying once if told to wait
+        .rate_limiter(AIORateLimiter(max_retries=1))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -383,9 +614,7 @@ def main():
         "broadcast": broadcast,
     }
 
-    handlers = [CommandHandler(command, callback) for command, callback in commands.items()]
-    for handler in handlers:
-        application.add_handler(handler)
+    application.add_handlers([CommandHandler(command, callback) for command, callback in commands.items()])
 
     application.run_polling()
 